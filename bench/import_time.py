@@ -0,0 +1,108 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2013 Jesse Keating <jkeating@j2solutions.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# import_time.py -- make sure "import pyendeavor" stays cheap
+#
+# Times a bare "import pyendeavor" in fresh interpreters and fails if it
+# takes longer than the budget or pulls in any of the heavy modules that
+# should only load when a submodule is used.  The submodules most scripts
+# start from are checked too: they may load what they need themselves,
+# but not the http or multiprocessing machinery until it is used.
+
+import json
+import optparse
+import os
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+# None of these should be loaded by just importing the package
+HEAVY = ('requests', 'xml.etree.ElementTree', 'multiprocessing', 'sqlite3',
+         'numpy', 'scipy', 'pyendeavor.api', 'pyendeavor.tcx')
+# Nor these by importing a module that builds or converts rides
+HEAVY_SUBMODULE = ('requests', 'multiprocessing', 'sqlite3', 'numpy', 'scipy',
+                   'pyendeavor.api')
+
+# Module to import and the modules it must not load; only the first is
+# held to the time budget
+TARGETS = (('pyendeavor', HEAVY),
+           ('pyendeavor.tcx', HEAVY_SUBMODULE),
+           ('pyendeavor.ride', HEAVY_SUBMODULE))
+
+_CHILD = """
+import sys, time, json
+start = time.time()
+import %s
+took = time.time() - start
+print(json.dumps({'took': took, 'modules': sorted(sys.modules)}))
+"""
+
+def measure(runs, module='pyendeavor'):
+    """Import a module in runs fresh interpreters
+
+    :param runs: Number of interpreters to start
+    :param module: Name of the module to import (defaults to pyendeavor)
+    :returns: A tuple of (sorted list of import times, set of modules that
+              were loaded)
+    """
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([SRC, env.get('PYTHONPATH', '')])
+    times = []
+    modules = set()
+    for run in range(runs):
+        out = subprocess.Popen([sys.executable, '-c', _CHILD % module],
+                               env=env,
+                               stdout=subprocess.PIPE).communicate()[0]
+        data = json.loads(out.decode('utf-8'))
+        times.append(data['took'])
+        modules.update(data['modules'])
+    return sorted(times), modules
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--runs', type='int', default=20,
+                      help='number of interpreters to time (default 20)')
+    parser.add_option('--budget', type='float', default=0.02,
+                      help='seconds the median import may take '
+                           '(default 0.02)')
+    opts, args = parser.parse_args()
+
+    failed = False
+    for module, heavy in TARGETS:
+        times, modules = measure(opts.runs, module)
+        median = times[len(times) // 2]
+        print('import %s: median %.2fms, max %.2fms over %d runs' %
+              (module, median * 1000, times[-1] * 1000, opts.runs))
+        loaded = [mod for mod in heavy if mod in modules]
+        if loaded:
+            print('FAIL: importing %s loaded %s' % (module, ', '.join(loaded)))
+            failed = True
+        if module == 'pyendeavor' and median > opts.budget:
+            print('FAIL: median import time is over the %.2fms budget' %
+                  (opts.budget * 1000))
+            failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2013 Jesse Keating <jkeating@j2solutions.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# route_match.py -- make sure route matching sees through recording noise
+#
+# Builds a winding synthetic ride and copies of it the way a second device
+# would record them: distances counted from a different starting point,
+# positions a few meters off, and a ride on a parallel road.  Fails if the
+# copies aren't found as duplicates with the default settings, or the
+# parallel ride is.
+
+import math
+import os
+import sys
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+from pyendeavor import route
+
+# Meters per degree of latitude
+_DEGREE = math.pi * route._EARTH_RADIUS / 180.0
+
+def ride(lat, lng, shift=0.0, noise=0.0, offset=0.0, seed=0):
+    """Make a stream for a winding ride about 20km long
+
+    :param lat: Latitude of the start
+    :param lng: Longitude of the start
+    :param shift: Meters to add to the distance channel
+    :param noise: Standard deviation of the position error in meters
+    :param offset: Meters to move the whole ride north
+    :param seed: Seed for the noise
+    :returns: A stream dict with 'latlng' and 'distance' channels
+    """
+
+    rand = numpy.random.RandomState(seed)
+    # A sample every 5m or so, like a GPS at speed
+    t = numpy.linspace(0, 1, 4000)
+    north = 12000 * t + 800 * numpy.sin(t * 9) + offset
+    east = 6000 * numpy.sin(t * 4) + 400 * numpy.cos(t * 17)
+    # Devices smooth the distance, so the noise only shows in positions
+    step = numpy.hypot(numpy.diff(north), numpy.diff(east))
+    distance = numpy.concatenate(([0.0], numpy.cumsum(step))) + shift
+    if noise:
+        north = north + rand.normal(0, noise, len(t))
+        east = east + rand.normal(0, noise, len(t))
+    lats = lat + north / _DEGREE
+    lngs = lng + east / (_DEGREE * math.cos(math.radians(lat)))
+    return {'latlng': [[a, b] for a, b in zip(lats, lngs)],
+            'distance': list(distance)}
+
+def check(lat, lng):
+    """Check duplicate finding on rides starting at lat, lng
+
+    :returns: A list of failure messages
+    """
+
+    failures = []
+    base = route.fingerprint('base', ride(lat, lng))
+    copies = {'shifted': ride(lat, lng, shift=20.0),
+              'noisy': ride(lat, lng, noise=3.0, seed=1),
+              'noisy shifted': ride(lat, lng, shift=35.0, noise=3.0, seed=2)}
+    index = route.RouteIndex()
+    index.add(base)
+    for name, stream in sorted(copies.items()):
+        fp = route.fingerprint(name, stream)
+        index.add(fp)
+        if not route.match(base, fp, 10.0, 0.98):
+            failures.append('%s copy at %.0f,%.0f does not match' %
+                            (name, lat, lng))
+    parallel = route.fingerprint('parallel', ride(lat, lng, offset=60.0))
+    index.add(parallel)
+    if route.match(base, parallel, 10.0, 0.98):
+        failures.append('parallel road at %.0f,%.0f matches' % (lat, lng))
+    found = index.duplicates()
+    expected = set(['base'] + list(copies))
+    if [set(group) for group in found] != [expected]:
+        failures.append('duplicates at %.0f,%.0f are %s' %
+                        (lat, lng, sorted(sorted(g) for g in found)))
+    return failures
+
+def main():
+    failures = []
+    for lat, lng in ((0.0, 0.0), (45.0, -122.0), (69.0, 18.0)):
+        failures.extend(check(lat, lng))
+    for failure in failures:
+        print('FAIL: %s' % failure)
+    if not failures:
+        print('route matching ok')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -22,10 +22,35 @@
 
 """
 pyendeavor module init code
+
+The submodules are loaded the first time they are used, e.g. on
+pyendeavor.ride, so that importing the package doesn't drag in requests,
+xml.etree and friends for programs that never use them.
 """
 
-import log
-import api
-import athlete
-import ride
-import tcx
+import importlib
+import sys
+import types
+
+_SUBMODULES = ('log', 'api', 'athlete', 'crawler', 'fit', 'profiling',
+               'resample', 'ride', 'route', 'shared', 'tcx')
+
+class _LazyModule(types.ModuleType):
+    """Package module that imports submodules on first attribute access"""
+
+    def __getattr__(self, name):
+        if name not in _SUBMODULES:
+            raise AttributeError("'module' object has no attribute '%s'" %
+                                 name)
+        # Importing sets the attribute on us, so this only happens once
+        return importlib.import_module('.' + name, self.__name__)
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_SUBMODULES))
+
+# Swap ourselves out for the lazy version.  Keep a reference to the original
+# module around, otherwise its globals get torn down under us.
+_lazy = _LazyModule(__name__, __doc__)
+_lazy.__dict__.update(sys.modules[__name__].__dict__)
+_lazy._module = sys.modules[__name__]
+sys.modules[__name__] = _lazy
@@ -21,10 +21,15 @@
 # pyendeavor.api -- API functions
 
 
+import collections
+import threading
+import time
+
 import requests
 
 # Create a logging facility
 from log import log
+import profiling
 
 
 # Set the URL -- class attribute, does not change per-instance
@@ -34,6 +39,113 @@ STREAMS = '%s/streams/' % APIURL
 LOGIN = '%s/authentication/login' % APIURL
 RIDES = '%s/rides' % APIURL
 
+# Seconds a GET may take in all, reading and decoding the response
+# included, before giving up on it.  (requests also gets it as its connect
+# and per read timeout, which on its own wouldn't stop a response that
+# keeps trickling in.)  Urls that start with one of the ENDPOINT_TIMEOUTS
+# prefixes use that timeout instead; streams can be large so they get a
+# bit longer.
+TIMEOUT = 30
+ENDPOINT_TIMEOUTS = {STREAMS: 60, RIDES: 30}
+
+# Hedged requests: when a GET has taken longer than this percentile of
+# recent GETs to the same endpoint, send a second one and use whichever
+# answers first.  None turns hedging off.  Hedging only starts once an
+# endpoint has HEDGE_MIN_SAMPLES latencies to go on.
+HEDGE_PERCENTILE = None
+HEDGE_MIN_SAMPLES = 20
+_latencies = {}
+_LATENCY_SAMPLES = 200
+
+# Circuit breaker: after BREAKER_THRESHOLD failed GETs in a row (timeouts,
+# connection errors, server errors) fail fast for BREAKER_COOLDOWN seconds,
+# then let a single GET through to see if things are better.  A threshold
+# of None turns the breaker off.
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30
+_breaker = {'failures': 0, 'opened': None, 'trial': False}
+
+# Concurrent GETs for the same url share a single in-flight request.  The
+# first caller (the leader) does the work, everybody else arriving while it
+# is running waits on it and gets the same decoded result (or exception).
+# They wait as long as the leader has, plus _FOLLOWER_GRACE seconds for it
+# to hand over what it got.
+_inflight = {}
+_FOLLOWER_GRACE = 1.0
+_inflight_lock = threading.Lock()
+
+# Counters for the request handling, see get_stats()
+_stats = {'requests': 0, 'coalesced': 0, 'timeouts': 0, 'failures': 0,
+          'hedged': 0, 'hedge_wins': 0, 'rejected': 0}
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of sending a GET while the circuit breaker is open"""
+
+
+class RideSummary(object):
+    """A compact record of a ride as returned by a ride listing
+
+    Every field the listing returns is kept.  Fields the listing did not
+    include are None (use has() to tell them apart from a null value), and
+    anything we don't know about ends up in the extra dict.
+
+    :param data: A dict representing a single ride from the listing
+    """
+
+    # Keep these lean; a listing of a whole club can be a lot of rides
+    fields = ('id', 'name', 'athlete', 'elapsedTime', 'startDate',
+              'distance', 'movingTime', 'bike', 'location')
+    __slots__ = fields + ('extra', '_present')
+
+    def __init__(self, data):
+        # Bit n is set when fields[n] was in the listing
+        present = 0
+        for bit, field in enumerate(self.fields):
+            setattr(self, field, data.get(field))
+            if field in data:
+                present |= 1 << bit
+        self._present = present
+        extra = dict((k, v) for k, v in data.items() if k not in self.fields)
+        self.extra = extra or None
+
+    def __repr__(self):
+        return 'RideSummary(id=%r, name=%r)' % (self.id, self.name)
+
+    def has(self, field):
+        """Check if the listing included a field, even if it was null
+
+        :param field: Name of the field
+        :returns: True if the field was in the listing
+        """
+
+        return bool(self._present & (1 << self.fields.index(field)))
+
+    def as_dict(self):
+        """Get the summary back as a dict like the listing returned
+
+        :returns: A dict of the fields that were present in the listing
+        """
+
+        data = dict((field, getattr(self, field)) for field in self.fields
+                    if self.has(field))
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+
+class _Call(object):
+    """An in-flight GET that other threads can wait on
+
+    :param deadline: time.time() by which the leader gives up
+    """
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
 def login(usermail, password):
     """Login to Strava to obtain a token and ID
 
@@ -43,23 +155,259 @@ def login(usermail, password):
     """
 
     resp = requests.post(LOGIN, data={'email': usermail,
-                                           'password': password})
+                                           'password': password},
+                         timeout=TIMEOUT)
     # Catch this on our own someday
     resp.raise_for_status()
     data = resp.json()
     return data['token']
 
-def get(url):
+def get_stats():
+    """Get the request counters
+
+    :returns: A dict with the number of http 'requests' actually sent
+              (hedged duplicates included), the number of calls that were
+              'coalesced' onto another thread's in-flight request instead
+              of sending their own, 'timeouts' and other 'failures' of
+              GETs, 'hedged' requests sent and how many of those were
+              'hedge_wins', and the number of GETs 'rejected' by the
+              circuit breaker.
+    """
+
+    with _inflight_lock:
+        return dict(_stats)
+
+def reset_stats():
+    """Reset the request counters to zero
+
+    :returns: Nothing
+    """
+
+    with _inflight_lock:
+        for key in _stats:
+            _stats[key] = 0
+
+def _endpoint(url):
+    """Find the ENDPOINT_TIMEOUTS prefix that url falls under, if any"""
+
+    best = None
+    for prefix in ENDPOINT_TIMEOUTS:
+        if url.startswith(prefix) and len(prefix) > len(best or ''):
+            best = prefix
+    return best
+
+def _count(key):
+    with _inflight_lock:
+        _stats[key] += 1
+
+def _allow():
+    """Check with the circuit breaker if a GET may be sent"""
+
+    if BREAKER_THRESHOLD is None:
+        return True
+    with _inflight_lock:
+        if _breaker['opened'] is None:
+            return True
+        # Let one GET through once we've cooled down
+        if (time.time() - _breaker['opened'] >= BREAKER_COOLDOWN and
+                not _breaker['trial']):
+            _breaker['trial'] = True
+            return True
+        return False
+
+def _release():
+    """Hand back a trial GET that ended without telling us anything about
+    the server, so the next GET can be the trial instead"""
+
+    with _inflight_lock:
+        _breaker['trial'] = False
+
+def _record(ok):
+    """Tell the circuit breaker how a GET went"""
+
+    with _inflight_lock:
+        if ok:
+            _breaker.update(failures=0, opened=None, trial=False)
+            return
+        _breaker['failures'] += 1
+        if BREAKER_THRESHOLD is None:
+            return
+        # A failed trial opens it right back up
+        if _breaker['trial'] or _breaker['failures'] >= BREAKER_THRESHOLD:
+            log.debug('Opening the circuit breaker after %d failures' %
+                      _breaker['failures'])
+            _breaker.update(opened=time.time(), trial=False)
+
+def _get(url, timeout, key=None):
+    log.debug('Sending GET for %s' % url)
+    _count('requests')
+    start = time.time()
+    resp = requests.get(url, timeout=timeout)
+    resp.raise_for_status()
+    with profiling.stage('json_decode', key):
+        data = resp.json()
+    endpoint = _endpoint(url)
+    with _inflight_lock:
+        samples = _latencies.get(endpoint)
+        if samples is None:
+            samples = _latencies[endpoint] = \
+                collections.deque(maxlen=_LATENCY_SAMPLES)
+        samples.append(time.time() - start)
+    return data
+
+def _hedge_delay(url):
+    """How long to wait on a GET before hedging it, None to not hedge"""
+
+    if HEDGE_PERCENTILE is None:
+        return None
+    with _inflight_lock:
+        samples = sorted(_latencies.get(_endpoint(url), ()))
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    index = int(len(samples) * HEDGE_PERCENTILE / 100.0)
+    return samples[min(index, len(samples) - 1)]
+
+def _send(url, timeout, deadline, delay):
+    """GET url on another thread so the whole request can be held to the
+    deadline, sending a second GET if the first takes longer than delay
+    (None to not hedge), and return whichever answers first"""
+
+    cond = threading.Condition()
+    outcomes = []
+    # The attempts run on their own threads, which don't know the ride
+    key = profiling.current_key()
+
+    def attempt(index):
+        try:
+            outcome = (index, _get(url, timeout, key), None)
+        except Exception as e:
+            outcome = (index, None, e)
+        with cond:
+            outcomes.append(outcome)
+            cond.notify()
+
+    def start(index):
+        thread = threading.Thread(target=attempt, args=(index,))
+        # An attempt we gave up on mustn't keep the interpreter around
+        thread.daemon = True
+        thread.start()
+
+    with cond:
+        threads = 1
+        start(0)
+        if delay is not None:
+            cond.wait(min(delay, max(deadline - time.time(), 0)))
+            if not outcomes and time.time() < deadline:
+                log.debug('Hedging GET for %s after %.3fs' % (url, delay))
+                _count('hedged')
+                threads = 2
+                start(1)
+        while True:
+            for index, result, error in outcomes:
+                if error is None:
+                    if index:
+                        _count('hedge_wins')
+                    return result
+            if len(outcomes) == threads:
+                raise outcomes[0][2]
+            left = deadline - time.time()
+            if left <= 0:
+                # Whatever is still running finishes on its own and is
+                # thrown away
+                raise requests.exceptions.Timeout('GET for %s took longer '
+                                                  'than %ss' % (url, timeout))
+            cond.wait(left)
+
+def _fetch(url, timeout, deadline):
+    """Send a GET through the circuit breaker, hedging it if asked to"""
+
+    if not _allow():
+        _count('rejected')
+        raise CircuitOpenError('circuit open, not sending GET for %s' % url)
+    delay = _hedge_delay(url)
+    try:
+        result = _send(url, timeout, deadline, delay)
+    except requests.exceptions.HTTPError as e:
+        # The server answered; only its own errors count against it
+        status = e.response.status_code if e.response is not None else 500
+        _record(status < 500)
+        if status >= 500:
+            _count('failures')
+        raise
+    except requests.exceptions.Timeout:
+        _count('timeouts')
+        _record(False)
+        raise
+    except requests.exceptions.RequestException:
+        _count('failures')
+        _record(False)
+        raise
+    except Exception:
+        # e.g. a garbled response that won't decode
+        _count('failures')
+        _record(False)
+        raise
+    except:
+        # KeyboardInterrupt and friends, don't leave a trial hanging
+        _release()
+        raise
+    _record(True)
+    return result
+
+def get(url, timeout=None):
     """Issue a http get request to the provided url
 
+    If another thread is already fetching the same url, wait for it and
+    share its result rather than sending a duplicate request.  The shared
+    result is the same object for every waiter, so callers should not
+    modify it.
+
+    The request is subject to the TIMEOUT/ENDPOINT_TIMEOUTS deadlines,
+    hedging and the circuit breaker configured at the top of this module.
+
     :param url: Constructed URL to GET against
+    :param timeout: Seconds the whole request may take (defaults to the
+                    endpoint's timeout)
     :returns: json data
     """
 
-    log.debug('Sending GET for %s' % url)
-    resp = requests.get(url)
-    resp.raise_for_status()
-    return resp.json()
+    if timeout is None:
+        timeout = ENDPOINT_TIMEOUTS.get(_endpoint(url), TIMEOUT)
+
+    with _inflight_lock:
+        call = _inflight.get(url)
+        if call is None:
+            leader = True
+            call = _inflight[url] = _Call(time.time() + timeout)
+        else:
+            leader = False
+            _stats['coalesced'] += 1
+
+    if not leader:
+        log.debug('Waiting on in-flight GET for %s' % url)
+        # Our own timeout doesn't matter, the leader's deadline is what
+        # bounds the request.  Not hearing back by then is our problem, not
+        # the server's, so it doesn't count as a timeout in the stats.
+        wait = max(call.deadline - time.time(), 0) + _FOLLOWER_GRACE
+        if not call.event.wait(wait):
+            raise requests.exceptions.Timeout('timed out waiting on '
+                                              'in-flight GET for %s' % url)
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        call.result = _fetch(url, timeout, call.deadline)
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        # Drop the entry before waking anybody up so that later calls
+        # issue a fresh request instead of reusing this one.
+        with _inflight_lock:
+            del _inflight[url]
+        call.event.set()
+    return call.result
 
 def post(url, data=None):
     """Issue an http post request to the provided url
@@ -70,7 +418,7 @@ def post(url, data=None):
     """
 
     log.debug('Sending POST for %s with data %s' % (url, data))
-    resp = requests.post(url, data)
+    resp = requests.post(url, data, timeout=TIMEOUT)
     resp.raise_for_status()
     return resp.json()
 
@@ -86,7 +434,7 @@ def get_rides(clubId=None, athleteId=None, athleteName=None,
     :param endDate: Day on which to end search for Rides.
     :param startId: Return Rides with an Id greater than or equal to the startId
     :param offset: Return Rides at offset
-    :returns: A list of dicts that represent individual rides
+    :returns: A list of RideSummary objects that represent individual rides
     """
 
     params = locals()
@@ -96,7 +444,7 @@ def get_rides(clubId=None, athleteId=None, athleteName=None,
                      if params[p]])
     url = RIDES + '?' + data
     rides = get(url)['rides']
-    return rides
+    return [RideSummary(ride) for ride in rides]
 
 def get_ride_data(rideId):
     """Get data about a specific ride
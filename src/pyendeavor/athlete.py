@@ -20,7 +20,6 @@
 #
 # pyendeavor.athlete -- a python library for interfacing with Strava Athletes
 
-import api
 from log import log
 import ride
 
@@ -50,11 +49,12 @@ class StravaAthlete(object):
         :returns: A list of StravaRide objects
         """
 
+        # api drags in requests, so only load it once we have to fetch
+        import api
         log.debug('Calling api.get_rides with extra args: %s' % args)
         ridelist = []
-        for ridedict in api.get_rides(athleteId=self.athlete_id, **args):
-            ridelist.append(ride.StravaRide(ridedict['id'],
-                                            name=ridedict['name']))
+        for summary in api.get_rides(athleteId=self.athlete_id, **args):
+            ridelist.append(ride.StravaRide(summary.id, summary=summary))
         return ridelist
 
     def get_all_rides(self, **args):
@@ -0,0 +1,341 @@
+# Copyright (c) 2013 Jesse Keating <jkeating@j2solutions.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# pyendeavor.crawler -- crawl clubs and athletes into a local database
+#
+# All the work is kept as tasks in a sqlite database next to the results,
+# so a crawl that dies part way through picks up where it left off.  There
+# are three kinds of task:
+#
+#   page   -- one page of a ride listing; queues the next page and a ride
+#             and stream task for every ride on it
+#   ride   -- the details of one ride
+#   stream -- the data stream of one ride
+#
+# Tasks are keyed on (kind, key), so a ride that turns up in more than one
+# listing is only ever fetched once.  A task that fails waits a while
+# before it is tried again (not_before), twice as long after each failure.
+# While the api circuit breaker is open tasks just wait it out, without
+# using up any of their attempts.
+
+import json
+import sqlite3
+import threading
+import time
+
+import api
+from log import log
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY (kind, key)
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state);
+CREATE TABLE IF NOT EXISTS rides (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS streams (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+"""
+
+# How many rides a listing page holds, see api.get_rides
+PAGESIZE = 50
+
+def _page_key(params, offset):
+    params = dict(params, offset=offset)
+    return json.dumps(params, sort_keys=True)
+
+class Crawler(object):
+    """A resumable crawler for Strava ride listings, details and streams
+
+    :param path: Path of the sqlite database to keep the work queue and
+                 results in.  It is created if it doesn't exist, and an
+                 existing one is resumed.
+    :param workers: Number of worker threads (defaults to 4)
+    :param max_attempts: Times to try a task before giving up on it
+                         (defaults to 3)
+    :param backoff: Seconds to wait before retrying a task that failed
+                    once, doubling with each further failure (defaults to 1)
+    :param max_backoff: Longest to wait before retrying a task, in seconds
+                        (defaults to 300)
+    """
+
+    def __init__(self, path, workers=4, max_attempts=3, backoff=1.0,
+                 max_backoff=300.0):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # One connection shared by the workers; the lock keeps them from
+        # stepping on each other; the http work happens outside of it.
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        # Databases from before retries were spaced out
+        columns = [row[1] for row in
+                   self._db.execute('PRAGMA table_info(tasks)')]
+        if 'not_before' not in columns:
+            self._db.execute('ALTER TABLE tasks ADD COLUMN '
+                             'not_before REAL NOT NULL DEFAULT 0')
+        # Anything that was running when we last stopped didn't finish
+        self._db.execute("UPDATE tasks SET state = 'pending' "
+                         "WHERE state = 'running'")
+        self._db.commit()
+
+    def close(self):
+        """Close the database
+
+        :returns: Nothing
+        """
+
+        self._db.close()
+
+    def _add(self, kind, key):
+        # Caller holds the lock
+        self._db.execute('INSERT OR IGNORE INTO tasks (kind, key) '
+                         'VALUES (?, ?)', (kind, str(key)))
+
+    def add_club(self, clubId, **args):
+        """Queue the rides of a club's members to be crawled
+
+        Extra arguments are passed along to api.get_rides, e.g. startDate.
+
+        :param clubId: Id of the Club to crawl
+        :returns: Nothing
+        """
+
+        args['clubId'] = clubId
+        with self._lock:
+            self._add('page', _page_key(args, 0))
+            self._db.commit()
+
+    def add_athlete(self, athleteId, **args):
+        """Queue the rides of an athlete to be crawled
+
+        Extra arguments are passed along to api.get_rides, e.g. startDate.
+
+        :param athleteId: Id of the Athlete to crawl
+        :returns: Nothing
+        """
+
+        args['athleteId'] = athleteId
+        with self._lock:
+            self._add('page', _page_key(args, 0))
+            self._db.commit()
+
+    def add_ride(self, rideId):
+        """Queue a single ride's details and stream to be crawled
+
+        :param rideId: Id of the Ride to crawl
+        :returns: Nothing
+        """
+
+        with self._lock:
+            self._add('ride', rideId)
+            self._add('stream', rideId)
+            self._db.commit()
+
+    def _claim(self):
+        """Grab the next pending task
+
+        :returns: A (kind, key) tuple, None if there is nothing to do right
+                  now but other tasks are running or waiting to be retried,
+                  or False when the crawl is finished
+        """
+
+        with self._lock:
+            row = self._db.execute("SELECT kind, key FROM tasks "
+                                   "WHERE state = 'pending' "
+                                   "AND not_before <= ? "
+                                   "ORDER BY kind = 'page' DESC "
+                                   "LIMIT 1", (time.time(),)).fetchone()
+            if row is None:
+                waiting = self._db.execute("SELECT COUNT(*) FROM tasks "
+                                           "WHERE state IN "
+                                           "('running', 'pending')")
+                return None if waiting.fetchone()[0] else False
+            self._db.execute("UPDATE tasks SET state = 'running', "
+                             "attempts = attempts + 1 "
+                             "WHERE kind = ? AND key = ?", row)
+            self._db.commit()
+            return row
+
+    def _run(self, kind, key):
+        """Do the work for a task and save what it found, returning the new
+        tasks it turned up"""
+
+        if kind == 'page':
+            params = json.loads(key)
+            rides = api.get_rides(**params)
+            tasks = []
+            if rides:
+                offset = params.pop('offset') + PAGESIZE
+                tasks.append(('page', _page_key(params, offset)))
+            for summary in rides:
+                tasks.append(('ride', summary.id))
+                tasks.append(('stream', summary.id))
+            return None, tasks
+        elif kind == 'ride':
+            data = api.get_ride_data(key)
+            return ('rides', key, data), []
+        elif kind == 'stream':
+            data = api.get(api.STREAMS + key)
+            return ('streams', key, data), []
+        raise ValueError('unknown task kind %s' % kind)
+
+    def _finish(self, kind, key, result, tasks):
+        with self._lock:
+            if result:
+                table, rideId, data = result
+                self._db.execute('INSERT OR REPLACE INTO %s (id, data) '
+                                 'VALUES (?, ?)' % table,
+                                 (str(rideId), json.dumps(data)))
+            for task in tasks:
+                self._add(*task)
+            self._db.execute("UPDATE tasks SET state = 'done', error = NULL "
+                             "WHERE kind = ? AND key = ?", (kind, key))
+            # Results, new tasks and the task being done all land together
+            self._db.commit()
+
+    def _fail(self, kind, key, error):
+        with self._lock:
+            attempts = self._db.execute('SELECT attempts FROM tasks '
+                                        'WHERE kind = ? AND key = ?',
+                                        (kind, key)).fetchone()[0]
+            if isinstance(error, api.CircuitOpenError):
+                # Nothing was sent, so this one doesn't count; come back
+                # when the breaker lets a request through again
+                attempts -= 1
+                delay = api.BREAKER_COOLDOWN
+            else:
+                delay = min(self.backoff * 2 ** (attempts - 1),
+                            self.max_backoff)
+            state = 'failed' if attempts >= self.max_attempts else 'pending'
+            self._db.execute('UPDATE tasks SET state = ?, error = ?, '
+                             'attempts = ?, not_before = ? '
+                             'WHERE kind = ? AND key = ?',
+                             (state, str(error), attempts,
+                              time.time() + delay, kind, key))
+            self._db.commit()
+
+    def _worker(self):
+        while True:
+            task = self._claim()
+            if task is False:
+                return
+            if task is None:
+                # Wait for a running page task to turn up more work, or for
+                # a failed task to be due for another try
+                time.sleep(0.1)
+                continue
+            kind, key = task
+            log.debug('Crawling %s %s' % (kind, key))
+            try:
+                result, tasks = self._run(kind, key)
+            except Exception as e:
+                log.debug('Crawling %s %s failed: %s' % (kind, key, e))
+                self._fail(kind, key, e)
+                continue
+            self._finish(kind, key, result, tasks)
+
+    def run(self):
+        """Work through the queue until everything is done or has failed
+
+        :returns: A dict of task counts by state
+        """
+
+        threads = [threading.Thread(target=self._worker)
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.progress()
+
+    def retry_failed(self):
+        """Put tasks that ran out of attempts back in the queue
+
+        :returns: Nothing
+        """
+
+        with self._lock:
+            self._db.execute("UPDATE tasks SET state = 'pending', "
+                             "attempts = 0, not_before = 0 "
+                             "WHERE state = 'failed'")
+            self._db.commit()
+
+    def progress(self):
+        """Get the number of tasks in each state
+
+        :returns: A dict of state to count
+        """
+
+        with self._lock:
+            rows = self._db.execute('SELECT state, COUNT(*) FROM tasks '
+                                    'GROUP BY state').fetchall()
+        return dict(rows)
+
+    def ride_ids(self):
+        """Get the ids of the rides crawled so far
+
+        :returns: A list of ride id strings
+        """
+
+        with self._lock:
+            rows = self._db.execute('SELECT id FROM rides').fetchall()
+        return [row[0] for row in rows]
+
+    def ride_data(self, rideId):
+        """Get the crawled details of a ride
+
+        :param rideId: Id of the Ride
+        :returns: json data about the ride, or None if it isn't crawled yet
+        """
+
+        return self._load('rides', rideId)
+
+    def stream_data(self, rideId):
+        """Get the crawled data stream of a ride
+
+        :param rideId: Id of the Ride
+        :returns: A dict collection of data points for the ride, or None if
+                  it isn't crawled yet
+        """
+
+        return self._load('streams', rideId)
+
+    def _load(self, table, rideId):
+        with self._lock:
+            row = self._db.execute('SELECT data FROM %s WHERE id = ?' % table,
+                                   (str(rideId),)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
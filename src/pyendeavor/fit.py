@@ -0,0 +1,276 @@
+# Copyright (c) 2013 Jesse Keating <jkeating@j2solutions.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# pyendeavor.fit -- code to work with the Garmin FIT binary format
+
+import datetime
+import os
+import struct
+
+# FIT timestamps are seconds since this moment, UTC
+FIT_EPOCH = datetime.datetime(1989, 12, 31)
+# Multiply degrees by this to get semicircles
+SEMICIRCLES = 2 ** 31 / 180.0
+
+_PROTOCOL_VERSION = 0x10
+_PROFILE_VERSION = 2093
+
+# Base types as (type byte, struct format, invalid value)
+_ENUM = (0x00, 'B', 0xFF)
+_UINT8 = (0x02, 'B', 0xFF)
+_SINT32 = (0x85, 'i', 0x7FFFFFFF)
+_UINT16 = (0x84, 'H', 0xFFFF)
+_UINT32 = (0x86, 'I', 0xFFFFFFFF)
+_UINT32Z = (0x8C, 'I', 0x00000000)
+
+# Message layouts we write as (global number, local number, fields) where
+# fields is a list of (field number, base type)
+_FILE_ID = (0, 0, [(0, _ENUM),        # type
+                   (1, _UINT16),      # manufacturer
+                   (2, _UINT16),      # product
+                   (3, _UINT32Z),     # serial_number
+                   (4, _UINT32)])     # time_created
+_RECORD = (20, 1, [(253, _UINT32),    # timestamp
+                   (0, _SINT32),      # position_lat
+                   (1, _SINT32),      # position_long
+                   (2, _UINT16),      # altitude
+                   (5, _UINT32),      # distance
+                   (6, _UINT16),      # speed
+                   (3, _UINT8),       # heart_rate
+                   (4, _UINT8)])      # cadence
+_LAP = (19, 2, [(253, _UINT32),       # timestamp
+                (2, _UINT32),         # start_time
+                (7, _UINT32),         # total_elapsed_time
+                (8, _UINT32),         # total_timer_time
+                (9, _UINT32),         # total_distance
+                (11, _UINT16),        # total_calories
+                (0, _ENUM),           # event
+                (1, _ENUM),           # event_type
+                (16, _UINT8),         # max_heart_rate
+                (23, _ENUM),          # intensity
+                (24, _ENUM),          # lap_trigger
+                (25, _ENUM)])         # sport
+_SESSION = (18, 3, [(253, _UINT32),   # timestamp
+                    (2, _UINT32),     # start_time
+                    (7, _UINT32),     # total_elapsed_time
+                    (8, _UINT32),     # total_timer_time
+                    (9, _UINT32),     # total_distance
+                    (11, _UINT16),    # total_calories
+                    (25, _UINT16),    # first_lap_index
+                    (26, _UINT16),    # num_laps
+                    (0, _ENUM),       # event
+                    (1, _ENUM),       # event_type
+                    (5, _ENUM),       # sport
+                    (17, _UINT8)])    # max_heart_rate
+_ACTIVITY = (34, 4, [(253, _UINT32),  # timestamp
+                     (0, _UINT32),    # total_timer_time
+                     (1, _UINT16),    # num_sessions
+                     (2, _ENUM),      # type
+                     (3, _ENUM),      # event
+                     (4, _ENUM)])     # event_type
+
+# Enum values used above
+_FILE_ACTIVITY = 4
+_MANUFACTURER_DEVELOPMENT = 255
+_EVENT_SESSION = 8
+_EVENT_LAP = 9
+_EVENT_ACTIVITY = 26
+_EVENT_TYPE_STOP = 1
+_SPORT_CYCLING = 2
+_INTENSITY_ACTIVE = 0
+_LAP_TRIGGER_MANUAL = 0
+_ACTIVITY_MANUAL = 0
+
+_CRC_TABLE = (0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
+              0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400)
+
+def _crc(data, crc=0):
+    """Compute the FIT CRC-16 of data
+
+    :param data: bytes to checksum
+    :param crc: CRC to continue from (defaults to 0)
+    :returns: integer CRC
+    """
+
+    for byte in bytearray(data):
+        tmp = _CRC_TABLE[crc & 0xF]
+        crc = (crc >> 4) & 0x0FFF
+        crc = crc ^ tmp ^ _CRC_TABLE[byte & 0xF]
+        tmp = _CRC_TABLE[crc & 0xF]
+        crc = (crc >> 4) & 0x0FFF
+        crc = crc ^ tmp ^ _CRC_TABLE[(byte >> 4) & 0xF]
+    return crc
+
+def _definition(message):
+    """Build the definition message and data struct for a message layout"""
+
+    globalnum, localnum, fields = message
+    defn = struct.pack('<BBBHB', 0x40 | localnum, 0, 0, globalnum,
+                       len(fields))
+    for num, basetype in fields:
+        defn += struct.pack('<BBB', num, struct.calcsize(basetype[1]),
+                            basetype[0])
+    data = struct.Struct('<B' + ''.join([f[1][1] for f in fields]))
+    return defn, data
+
+def _timestamp(value):
+    """Convert a datetime into a FIT timestamp"""
+
+    delta = value - FIT_EPOCH
+    return int(delta.days * 86400 + delta.seconds)
+
+def _scaled(value, scale, offset, invalid):
+    """Scale a value into a FIT integer, or invalid if it won't fit"""
+
+    if value is None:
+        return invalid
+    value = int(round((value + offset) * scale))
+    if value < 0 or value >= invalid:
+        return invalid
+    return value
+
+def _semicircles(value):
+    if value is None:
+        return _SINT32[2]
+    # Wrap around into the sint32 range, so longitude 180 is -180, and
+    # keep off the invalid value just short of it
+    value = (int(round(value * SEMICIRCLES)) + 2 ** 31) % 2 ** 32 - 2 ** 31
+    return min(value, _SINT32[2] - 1)
+
+def _small(value):
+    """Convert an optional uint8 like heartrate or cadence"""
+
+    if not value or value < 0 or value >= 0xFF:
+        return 0xFF
+    return int(value)
+
+_FILE_ID_DEF, _FILE_ID_DATA = _definition(_FILE_ID)
+_RECORD_DEF, _RECORD_DATA = _definition(_RECORD)
+_LAP_DEF, _LAP_DATA = _definition(_LAP)
+_SESSION_DEF, _SESSION_DATA = _definition(_SESSION)
+_ACTIVITY_DEF, _ACTIVITY_DATA = _definition(_ACTIVITY)
+
+class FIT(object):
+    """A class to create FIT activity files
+
+    This covers the same activity and lap data as the TCX class, written as
+    a single lap, single session cycling activity.
+
+    :param starttime: datetime object (UTC) for the start of the ride
+    """
+
+    def __init__(self, starttime):
+        self.starttime = starttime
+        self._start = _timestamp(starttime)
+        # Packed record messages, joined together when we encode
+        self._records = []
+        self._last = self._start
+        # Define some psuedo properties for the lap data
+        self.distance = None
+        self.duration = None
+        self.maxhr = None
+        self.calories = 0
+
+    def add_point(self, time=0, latitude=0, longitude=0, altitude=0,
+                  distance=0, speed=0, heartrate=0, cadence=0):
+        """Add a trackpoint to the ride
+
+        :param time: GPS timestamp (datetime object, UTC)
+        :param latitude: latitude degrees
+        :param longitude: longitude degrees
+        :param altitude: altitude meters
+        :param distance: distance meters
+        :param speed: speed meters per second
+        :param heartrate: heartrate bpm (optional)
+        :param cadence: cadence rpm (optional)
+        :returns: Nothing
+        """
+
+        tstamp = _timestamp(time) if time else self._start
+        if tstamp > self._last:
+            self._last = tstamp
+        self._records.append(_RECORD_DATA.pack(
+            _RECORD[1],
+            tstamp,
+            _semicircles(latitude),
+            _semicircles(longitude),
+            _scaled(altitude, 5, 500, 0xFFFF),
+            _scaled(distance, 100, 0, 0xFFFFFFFF),
+            _scaled(speed, 1000, 0, 0xFFFF),
+            _small(heartrate),
+            _small(cadence)))
+
+    def encode(self):
+        """Encode the FIT file
+
+        :returns: bytes of the complete FIT file, header and CRC included
+        """
+
+        duration = _scaled(self.duration, 1000, 0, 0xFFFFFFFF)
+        distance = _scaled(self.distance, 100, 0, 0xFFFFFFFF)
+        calories = _scaled(self.calories, 1, 0, 0xFFFF)
+        maxhr = _small(self.maxhr)
+        if self.duration is not None:
+            end = self._start + int(self.duration)
+        else:
+            end = self._last
+
+        chunks = [_FILE_ID_DEF,
+                  _FILE_ID_DATA.pack(_FILE_ID[1], _FILE_ACTIVITY,
+                                     _MANUFACTURER_DEVELOPMENT, 0, 0,
+                                     self._start),
+                  _RECORD_DEF]
+        chunks.extend(self._records)
+        chunks.extend([
+            _LAP_DEF,
+            _LAP_DATA.pack(_LAP[1], end, self._start, duration, duration,
+                           distance, calories, _EVENT_LAP, _EVENT_TYPE_STOP,
+                           maxhr, _INTENSITY_ACTIVE, _LAP_TRIGGER_MANUAL,
+                           _SPORT_CYCLING),
+            _SESSION_DEF,
+            _SESSION_DATA.pack(_SESSION[1], end, self._start, duration,
+                               duration, distance, calories, 0, 1,
+                               _EVENT_SESSION, _EVENT_TYPE_STOP,
+                               _SPORT_CYCLING, maxhr),
+            _ACTIVITY_DEF,
+            _ACTIVITY_DATA.pack(_ACTIVITY[1], end, duration, 1,
+                                _ACTIVITY_MANUAL, _EVENT_ACTIVITY,
+                                _EVENT_TYPE_STOP)])
+        data = b''.join(chunks)
+
+        header = struct.pack('<BBHI4s', 14, _PROTOCOL_VERSION,
+                             _PROFILE_VERSION, len(data), b'.FIT')
+        header += struct.pack('<H', _crc(header))
+        crc = _crc(data, _crc(header))
+        return header + data + struct.pack('<H', crc)
+
+    def write(self, path, force=False):
+        """Write the fit content to the file at path
+
+        :param path: absolute path name to the file
+        :param force: force overwrite of existing file (defaults to False)
+        :returns: nothing
+        """
+
+        if os.path.exists(path) and not force:
+            raise IOError('file %s exists' % path)
+        fileobj = open(path, 'wb')
+        fileobj.write(self.encode())
+        fileobj.close()
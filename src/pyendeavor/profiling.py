@@ -0,0 +1,339 @@
+# Copyright (c) 2013 Jesse Keating <jkeating@j2solutions.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# pyendeavor.profiling -- time and memory use of the ride to TCX pipeline
+#
+# The pipeline is split into stages which record wall time, CPU time and
+# peak memory allocated while they run:
+#
+#   _get_ride_details -- fetching the ride data
+#   _get_ride_stream  -- fetching the ride stream
+#   json_decode       -- decoding an api response
+#   _stream_to_tcx    -- building the TCX from the stream
+#   format_points     -- building Trackpoint xml for add_points() points
+#   indent            -- pretty printing the TCX tree
+#   serialize         -- writing the TCX out
+#   format_chunks     -- waiting on worker processes formatting points for
+#                        TCX.write(processes=...); what the workers spent
+#                        goes under format_points, indent and serialize
+#
+# Nothing is recorded unless a Profiler is running:
+#
+#   with profiling.Profiler() as prof:
+#       myride.tcx.write(path)
+#   prof.report(myride.id)
+#   prof.summary()
+#
+# Stages nest, e.g. _stream_to_tcx includes fetching the stream if it has
+# to, so the numbers of a stage include those of the stages inside it.
+# Memory peaks come from tracemalloc, which is process wide, so they are
+# only meaningful for one ride at a time per process.  Without tracemalloc
+# (Python 2) the peak of a stage is how much it raised the process's peak
+# resident size (ru_maxrss) instead.  That is coarser: a stage only shows
+# up if it pushes the process past its previous high water mark.  Every
+# entry says which of the two its 'metric' is.
+
+import os
+import sys
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Per thread CPU time where we can get it, otherwise the whole process
+if hasattr(time, 'thread_time'):
+    _cpu = time.thread_time
+else:
+    def _cpu():
+        times = os.times()
+        return times[0] + times[1]
+
+# The running Profiler, if any
+_active = None
+# Each thread's stack of stages being timed
+_local = threading.local()
+
+def _traced_peak():
+    return tracemalloc.get_traced_memory()[1]
+
+# ru_maxrss is in kilobytes, except on OS X where it is bytes
+_RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+def _maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RSS_UNIT
+
+def _max(a, b):
+    # max() that treats None as nothing recorded
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+class _NullStage(object):
+    """Stand in for a stage when nothing is profiling"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULL = _NullStage()
+
+class _Stage(object):
+    """A stage being timed"""
+
+    def __init__(self, profiler, name, key):
+        self.profiler = profiler
+        self.name = name
+        self.key = key
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        # Stages inside a ride's stage belong to that ride
+        if self.key is None and stack:
+            self.key = stack[-1].key
+        self.memory = self.profiler.metric == 'tracemalloc' and \
+            tracemalloc.is_tracing()
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # Save what the outer stage has seen so far before we reset
+            if stack and stack[-1].memory:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            self.base = current
+            self.peak = current
+        elif self.profiler.metric == 'maxrss':
+            # Never goes down, so the outer stages see ours without help
+            self.base = _maxrss()
+        stack.append(self)
+        self.wall = time.time()
+        self.cpu = _cpu()
+        return self
+
+    def __exit__(self, *args):
+        wall = time.time() - self.wall
+        cpu = _cpu() - self.cpu
+        stack = _local.stack
+        stack.pop()
+        peak = None
+        if self.memory:
+            self.peak = max(self.peak, _traced_peak())
+            peak = self.peak - self.base
+            # Everything we allocated was allocated during the outer stage
+            if stack and stack[-1].memory:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+        elif self.profiler.metric == 'maxrss':
+            peak = _maxrss() - self.base
+        self.profiler._record(self.key, self.name, wall, cpu, peak)
+        return False
+
+def stage(name, key=None):
+    """Time a stage of the pipeline, for use in a with statement
+
+    :param name: Name of the stage
+    :param key: Ride the stage is for (defaults to that of the stage this
+                one is inside)
+    :returns: A context manager
+    """
+
+    profiler = _active
+    if profiler is None:
+        return _NULL
+    return _Stage(profiler, name, key)
+
+def current_key():
+    """Get the ride of the stage running on this thread, to hand to stages
+    run for it on other threads
+
+    :returns: A ride id, or None
+    """
+
+    stack = getattr(_local, 'stack', None)
+    if not stack:
+        return None
+    return stack[-1].key
+
+def clock():
+    """Read the clocks stages are timed with, to time work somewhere a
+    stage can't be, such as in a worker process
+
+    :returns: A tuple of (wall, cpu) seconds
+    """
+
+    return time.time(), _cpu()
+
+def record(name, wall, cpu, key=None):
+    """Record a stage timed with clock(), without its memory use
+
+    :param name: Name of the stage
+    :param wall: Wall time in seconds
+    :param cpu: CPU time in seconds
+    :param key: Ride the stage is for (defaults to that of the stage
+                running on this thread)
+    :returns: Nothing
+    """
+
+    profiler = _active
+    if profiler is None:
+        return
+    if key is None:
+        key = current_key()
+    profiler._record(key, name, wall, cpu, None)
+
+def staged(name):
+    """Decorator to time a StravaRide method as a stage of the pipeline
+
+    :param name: Name of the stage
+    """
+
+    def decorator(func):
+        def wrapper(self, *args, **kwargs):
+            with stage(name, getattr(self, 'id', None)):
+                return func(self, *args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+class Profiler(object):
+    """Collect per stage timings and memory use for each ride
+
+    :param memory: Track peak memory, with tracemalloc when available and
+                   ru_maxrss otherwise (defaults to True)
+    """
+
+    def __init__(self, memory=True):
+        # How peaks are measured: 'tracemalloc', 'maxrss' or None
+        self.metric = None
+        if memory and tracemalloc is not None:
+            self.metric = 'tracemalloc'
+        elif memory and resource is not None:
+            self.metric = 'maxrss'
+        self._lock = threading.Lock()
+        self._reports = {}
+        self._started_tracing = False
+
+    def start(self):
+        """Start profiling.  Only one Profiler can run at a time.
+
+        :returns: Nothing
+        """
+
+        global _active
+        if _active is not None:
+            raise RuntimeError('a profiler is already running')
+        if self.metric == 'tracemalloc' and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        _active = self
+
+    def stop(self):
+        """Stop profiling
+
+        :returns: Nothing
+        """
+
+        global _active
+        if _active is self:
+            _active = None
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _record(self, key, name, wall, cpu, peak):
+        with self._lock:
+            report = self._reports.setdefault(key, {})
+            entry = report.get(name)
+            if entry is None:
+                entry = report[name] = {'calls': 0, 'wall': 0.0, 'cpu': 0.0,
+                                        'peak': peak, 'metric': self.metric}
+            entry['calls'] += 1
+            entry['wall'] += wall
+            entry['cpu'] += cpu
+            entry['peak'] = _max(entry['peak'], peak)
+
+    def keys(self):
+        """Get the rides there are reports for
+
+        :returns: A list of ride ids (None for stages outside of any ride)
+        """
+
+        with self._lock:
+            return list(self._reports)
+
+    def report(self, key):
+        """Get the report of a single ride
+
+        :param key: Ride id
+        :returns: A dict of stage name to a dict of 'calls', 'wall' and
+                  'cpu' seconds, 'peak' bytes allocated (or None) and the
+                  'metric' peak was measured with ('tracemalloc', 'maxrss'
+                  or None)
+        """
+
+        with self._lock:
+            report = self._reports.get(key, {})
+            return dict((name, dict(entry)) for name, entry in report.items())
+
+    def summary(self):
+        """Get the reports of all rides added up
+
+        :returns: A dict of stage name to a dict of the number of 'rides'
+                  and 'calls', total 'wall' and 'cpu' seconds, the largest
+                  'wall' time of a single ride as 'wall_max', and the
+                  largest 'peak' bytes allocated by a single ride (or None)
+                  and the 'metric' it was measured with
+        """
+
+        summary = {}
+        with self._lock:
+            for report in self._reports.values():
+                for name, entry in report.items():
+                    total = summary.setdefault(name, {
+                        'rides': 0, 'calls': 0, 'wall': 0.0, 'cpu': 0.0,
+                        'wall_max': 0.0, 'peak': None,
+                        'metric': entry['metric']})
+                    total['rides'] += 1
+                    total['calls'] += entry['calls']
+                    total['wall'] += entry['wall']
+                    total['cpu'] += entry['cpu']
+                    total['wall_max'] = max(total['wall_max'], entry['wall'])
+                    total['peak'] = _max(total['peak'], entry['peak'])
+        return summary
@@ -0,0 +1,166 @@
+# Copyright (c) 2013 Jesse Keating <jkeating@j2solutions.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# pyendeavor.resample -- resample ride streams onto uniform grids
+#
+# This module needs numpy, which the rest of pyendeavor does not, so it is
+# not imported by the package init.  Use "from pyendeavor import resample".
+
+import numpy
+
+from log import log
+
+# Channels that hold state rather than a measurement; these take the value
+# of the previous sample instead of being interpolated.
+_HOLD = ('moving',)
+
+def _channels(stream):
+    """Turn a stream dict into float arrays, splitting latlng into lat/lng"""
+
+    channels = {}
+    for key, values in stream.items():
+        if key == 'latlng':
+            latlng = numpy.array([p if p else (None, None) for p in values],
+                                 dtype=float).reshape(-1, 2)
+            channels['lat'] = latlng[:, 0]
+            channels['lng'] = latlng[:, 1]
+        else:
+            channels[key] = numpy.array(values, dtype=float)
+    return channels
+
+def _axis(channels, axis):
+    """Get the sample positions along axis, dropping samples that don't
+    move it forward (pauses on the distance axis, duplicate timestamps)"""
+
+    x = channels[axis]
+    keep = numpy.isfinite(x)
+    keep[1:] &= numpy.diff(numpy.fmax.accumulate(
+        numpy.where(keep, x, -numpy.inf))) > 0
+    return numpy.flatnonzero(keep)
+
+def resample(stream, axis='time', step=1.0, max_gap=None, start=None,
+             stop=None):
+    """Project every channel of a ride stream onto a uniform grid
+
+    Grid points that fall outside the ride, inside a gap in the recording
+    longer than max_gap, or where the 'moving' channel says the rider was
+    stopped are masked out and their values set to NaN.
+
+    :param stream: A stream dict, as from StravaRide.stream
+    :param axis: Stream channel to use as the grid, 'time' (seconds) or
+                 'distance' (meters) (defaults to 'time')
+    :param step: Grid spacing in axis units (defaults to 1.0)
+    :param max_gap: Largest spacing between recorded samples, in axis units,
+                    to interpolate across (defaults to None, no limit)
+    :param start: First grid point (defaults to 0)
+    :param stop: Grid end, exclusive (defaults to the end of the ride)
+    :returns: A dict of numpy arrays keyed by channel, with latlng split
+              into 'lat' and 'lng', plus a boolean 'mask' of valid points
+    """
+
+    channels = _channels(stream)
+    idx = _axis(channels, axis)
+    x = channels[axis][idx]
+    if start is None:
+        start = 0.0
+    if stop is None:
+        stop = x[-1] + step if len(x) else start
+    grid = numpy.arange(start, stop, step)
+    log.debug('Resampling %d samples onto %d points of %s' %
+              (len(channels[axis]), len(grid), axis))
+
+    out = {axis: grid}
+    if not len(x):
+        out['mask'] = numpy.zeros(len(grid), dtype=bool)
+        for key in channels:
+            out.setdefault(key, numpy.nan * grid)
+        return out
+
+    # Where does each grid point land among the recorded samples
+    right = numpy.searchsorted(x, grid, side='right')
+    left = right - 1
+    mask = (grid >= x[0]) & (grid <= x[-1])
+    if max_gap is not None:
+        # Points landing right on a sample are fine however far away the
+        # next one is
+        inside = (right < len(x)) & (left >= 0)
+        inside[inside] &= grid[inside] > x[left[inside]]
+        gaps = numpy.zeros(len(grid), dtype=bool)
+        gaps[inside] = (x[right[inside]] - x[left[inside]]) > max_gap
+        mask &= ~gaps
+
+    for key, values in channels.items():
+        if key == axis:
+            continue
+        values = values[idx]
+        if key in _HOLD:
+            held = values[numpy.clip(left, 0, len(x) - 1)]
+            if key == 'moving':
+                mask &= held > 0
+            out[key] = held
+            continue
+        # Only interpolate between samples that actually have a value
+        good = numpy.isfinite(values)
+        if good.any():
+            out[key] = numpy.interp(grid, x[good], values[good])
+        else:
+            out[key] = numpy.nan * grid
+
+    for key in out:
+        if key != axis:
+            out[key][~mask] = numpy.nan
+    out['mask'] = mask
+    return out
+
+def resample_many(streams, channel, axis='time', step=1.0, max_gap=None):
+    """Resample one channel of many rides onto a single shared grid
+
+    :param streams: An iterable of stream dicts, as from StravaRide.stream
+    :param channel: Name of the channel to collect, e.g. 'heartrate'
+    :param axis: Stream channel to use as the grid (defaults to 'time')
+    :param step: Grid spacing in axis units (defaults to 1.0)
+    :param max_gap: Largest spacing between recorded samples to interpolate
+                    across (defaults to None, no limit)
+    :returns: A tuple of (grid, data) where data is a 2-D numpy array with
+              a row per ride, NaN wherever a ride has no valid value
+    """
+
+    streams = list(streams)
+    # Work out the longest ride so every row lines up on the same grid
+    stop = 0.0
+    for stream in streams:
+        values = numpy.array(stream[axis], dtype=float)
+        if len(values):
+            stop = max(stop, numpy.nanmax(values))
+    grid = numpy.arange(0.0, stop + step, step)
+
+    data = numpy.empty((len(streams), len(grid)))
+    data.fill(numpy.nan)
+    for row, stream in enumerate(streams):
+        # Only hand over the channels we need to keep the work down
+        wanted = [axis, channel] + [k for k in _HOLD if k in stream]
+        if channel in ('lat', 'lng'):
+            wanted[1] = 'latlng'
+        sub = dict((k, stream[k]) for k in wanted if k in stream)
+        out = resample(sub, axis=axis, step=step, max_gap=max_gap,
+                       start=grid[0], stop=grid[-1] + step / 2.0)
+        if channel in out:
+            data[row, :len(out[axis])] = out[channel]
+    return grid, data
@@ -20,8 +20,9 @@
 #
 # pyendeavor.ride -- code to work with Strava Rides
 
-import api
 import athlete
+import fit
+import profiling
 import tcx
 from log import log
 import datetime
@@ -31,12 +32,16 @@ class StravaRide(object):
 
     :param id: Ride ID to use
     :param name: Ride name to use (optional)
+    :param summary: api.RideSummary from a ride listing to pre-populate the
+                    ride properties from (optional)
+    :param stream: Stream data for the ride if it is already at hand, e.g.
+                   a shared.AttachedStream (optional)
     """
 
     # We use this to convert from strava's time stamp to a datetime object
     _tstampformat = '%Y-%m-%dT%H:%M:%SZ'
 
-    def __init__(self, id, name=None):
+    def __init__(self, id, name=None, summary=None, stream=None):
         self.id = str(id)
         # Define some placeholders for ride properties
         self._athlete = None
@@ -47,71 +52,78 @@ class StravaRide(object):
         self._movingTime = None
         self._bike = None
         self._location = None
-        self._stream = None
+        self._stream = stream
         self._tcx = None
+        self._fit = None
+        # Names of the ride details we have, whatever their value
+        self._loaded = set()
+        if name is not None:
+            self._loaded.add('name')
+        if summary:
+            self._load_summary(summary)
 
     # Put all the property stubs here.
     @property
     def athlete(self):
         """A StravaAthlete object representation of the athlete who performed
         the ride"""
-        if not self._athlete:
+        if 'athlete' not in self._loaded:
             self._get_ride_details()
         return self._athlete
 
     @property
     def elapsedTime(self):
         """Total time in seconds for the ride"""
-        if not self._elapsedTime:
+        if 'elapsedTime' not in self._loaded:
             self._get_ride_details()
         return self._elapsedTime
 
     @property
     def startDate(self):
         """Timestamp in UTC of when the ride started"""
-        if not self._startDate:
+        if 'startDate' not in self._loaded:
             self._get_ride_details()
         return self._startDate
 
     @property
     def name(self):
         """Name of the ride"""
-        if not self._name:
+        if 'name' not in self._loaded:
             self._get_ride_details()
         return self._name
 
     @property
     def distance(self):
         """Distance of the ride"""
-        if not self._distance:
+        if 'distance' not in self._loaded:
             self._get_ride_details()
         return self._distance
 
     @property
     def movingTime(self):
         """Total time in seconds spent moving on the ride"""
-        if not self._movingTime:
+        if 'movingTime' not in self._loaded:
             self._get_ride_details()
         return self._movingTime
 
     @property
     def bike(self):
         """A dict representing bike data used for the ride"""
-        if not self._bike:
+        if 'bike' not in self._loaded:
             self._get_ride_details()
         return self._bike
 
     @property
     def location(self):
         """A string of closest known Location to the ride start"""
-        if not self._location:
+        if 'location' not in self._loaded:
             self._get_ride_details()
         return self._location
 
     @property
     def stream(self):
         """A dict collection of data points for the ride"""
-        if not self._stream:
+        if self._stream is None:
             self._get_ride_stream()
         return self._stream
 
@@ -122,8 +134,18 @@ class StravaRide(object):
             self._stream_to_tcx()
         return self._tcx
 
+    @property
+    def fit(self):
+        """A FIT object representation of the ride data points"""
+        if not self._fit:
+            self._stream_to_fit()
+        return self._fit
+
     # This is something of an internal function that just populates data
+    @profiling.staged('_get_ride_details')
     def _get_ride_details(self):
+        # api drags in requests, so only load it once we have to fetch
+        import api
         url = api.RIDES + '/' + self.id
         resp = api.get(url)
         data = resp['ride']
@@ -135,31 +157,35 @@ class StravaRide(object):
         self._movingTime = data['movingTime']
         self._bike = data['bike']
         self._location = data['location']
+        self._loaded.update(api.RideSummary.fields)
+
+    # Fill in whatever the listing already gave us so the properties don't
+    # have to go back to the API for it
+    def _load_summary(self, summary):
+        import api
+        for field in api.RideSummary.fields:
+            if field == 'id' or not summary.has(field):
+                continue
+            value = getattr(summary, field)
+            if field == 'athlete' and value is not None:
+                value = athlete.StravaAthlete(value['id'])
+            setattr(self, '_' + field, value)
+            self._loaded.add(field)
 
     # Another internal function to populate an attribute
+    @profiling.staged('_get_ride_stream')
     def _get_ride_stream(self):
+        import api
         url = api.STREAMS + self.id
         data = api.get(url)
         self._stream = data
 
-    # This is a really expensive call, so much meat and awesomeness
-    def _stream_to_tcx(self):
-        # Get a useful time object of our start time
-        starttime = datetime.datetime.strptime(self.startDate,
-                                               self._tstampformat)
-        # Create a new blank tcx object
-        _tcx = tcx.TCX(self.startDate)
-        # Set various attributes
-        _tcx.distance = self.distance
-        _tcx.duration = self.elapsedTime
-        try:
-            _tcx.maxhr = max(self.stream['heartrate'])
-        except KeyError:
-            # We might not have heartrate data in the stream
-            pass
+    # Walk the stream and hand back the data for each point as a dict of
+    # add_point() arguments, shared by the tcx and fit builders
+    def _stream_points(self, starttime):
         # Figure out how long our stream is
         pointcount = len(self.stream['latlng'])
-        # Loop through the data in our stream and create gpx points
+        # Loop through the data in our stream and create points
         for snapshot in range(pointcount):
             # Save some typing by referencing bits of data by name
             args = {}
@@ -181,7 +207,42 @@ class StravaRide(object):
                 args['cadence'] = self.stream['cadence'][snapshot]
             except KeyError:
                 pass
-            # Create the point with the above gathered data
-            _tcx.add_point(**args)
+            yield args
+
+    # This is a really expensive call, so much meat and awesomeness
+    @profiling.staged('_stream_to_tcx')
+    def _stream_to_tcx(self):
+        # Get a useful time object of our start time
+        starttime = datetime.datetime.strptime(self.startDate,
+                                               self._tstampformat)
+        # Create a new blank tcx object
+        _tcx = tcx.TCX(self.startDate)
+        _tcx.ride_id = self.id
+        # Set various attributes
+        _tcx.distance = self.distance
+        _tcx.duration = self.elapsedTime
+        try:
+            _tcx.maxhr = max(self.stream['heartrate'])
+        except KeyError:
+            # We might not have heartrate data in the stream
+            pass
+        # Hand the points over in bulk so their xml gets built when the tcx
+        # is written, possibly in parallel
+        _tcx.add_points(self._stream_points(starttime))
         self._tcx = _tcx
 
+    # Same as above, but packed into a much smaller binary FIT file
+    def _stream_to_fit(self):
+        starttime = datetime.datetime.strptime(self.startDate,
+                                               self._tstampformat)
+        _fit = fit.FIT(starttime)
+        _fit.distance = self.distance
+        _fit.duration = self.elapsedTime
+        try:
+            _fit.maxhr = max(self.stream['heartrate'])
+        except KeyError:
+            # We might not have heartrate data in the stream
+            pass
+        for args in self._stream_points(starttime):
+            _fit.add_point(**args)
+        self._fit = _fit
@@ -0,0 +1,389 @@
+# Copyright (c) 2013 Jesse Keating <jkeating@j2solutions.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# pyendeavor.route -- group rides by route and find duplicate uploads
+#
+# Like resample, this needs numpy (and scipy) so it is not imported by the
+# package init.  Use "from pyendeavor import route".
+#
+# Each ride is boiled down to a Fingerprint: its path resampled every few
+# tens of meters, as 3-D earth centered coordinates so distances between
+# points are true meters anywhere on the globe, and the set of map cells
+# that path passes through.  A MinHash of the cell set goes into a
+# RouteIndex, so finding candidate matches is a few dict lookups rather
+# than a comparison against every other ride.  Candidates are then
+# confirmed by measuring how far the points of each path are from the
+# other path, found with a KD-tree.  That is the distance to the line
+# between the other path's points, not to the points themselves, which
+# can be up to half a resampling step apart on two recordings of the
+# very same road.
+
+import datetime
+
+import numpy
+from scipy.spatial import cKDTree
+
+from log import log
+import resample
+
+# Mean earth radius in meters, for turning degrees into meters
+_EARTH_RADIUS = 6371000.0
+
+def _ecef(lat, lng):
+    """Turn degrees into earth centered x, y, z meters on a spherical
+    earth.  The straight line distance between two points is within a
+    hair of the distance over the ground at the scale of a ride."""
+
+    lat = numpy.radians(lat)
+    lng = numpy.radians(lng)
+    coslat = numpy.cos(lat)
+    return _EARTH_RADIUS * numpy.column_stack((coslat * numpy.cos(lng),
+                                               coslat * numpy.sin(lng),
+                                               numpy.sin(lat)))
+
+def _cells(lat, lng, cellsize):
+    """Number the map cells the points fall in.  Cells are cellsize meters
+    of latitude tall, and each band of latitude is cut into cells cellsize
+    meters wide at the middle of the band, so they stay square from the
+    equator up to the poles."""
+
+    height = numpy.degrees(cellsize / _EARTH_RADIUS)
+    band = numpy.floor(lat / height)
+    middle = numpy.radians((band + 0.5) * height)
+    # Don't let the cells get infinitely wide right at the poles
+    width = height / numpy.maximum(numpy.cos(middle), 1e-6)
+    column = numpy.floor(lng / width)
+    band = band.astype(numpy.int64)
+    column = column.astype(numpy.int64)
+    # Pack the pair into one integer
+    return numpy.unique((band << 32) ^ (column & 0xFFFFFFFF))
+
+class Fingerprint(object):
+    """A compact signature of the route a ride took
+
+    :param key: Identifier for the ride, usually its id
+    :param points: Nx3 array of the path in earth centered meters, evenly
+                   spaced
+    :param cells: Array of the ids of the map cells the path visits
+    :param length: Length of the path in meters
+    :param start: datetime the ride started (optional)
+    """
+
+    __slots__ = ('key', 'points', 'cells', 'length', 'start', '_tree')
+
+    def __init__(self, key, points, cells, length, start=None):
+        self.key = key
+        self.points = points
+        self.cells = cells
+        self.length = length
+        self.start = start
+        self._tree = None
+
+    def __repr__(self):
+        return 'Fingerprint(key=%r, length=%r)' % (self.key, self.length)
+
+    @property
+    def tree(self):
+        """A KD-tree over the path points, built on first use"""
+        if self._tree is None:
+            self._tree = cKDTree(self.points)
+        return self._tree
+
+def fingerprint(key, stream, step=50.0, cellsize=250.0, start=None):
+    """Build the route fingerprint of a ride stream
+
+    :param key: Identifier for the ride, usually its id
+    :param stream: A stream dict with 'latlng' and 'distance' channels
+    :param step: Spacing in meters to resample the path at (defaults to 50)
+    :param cellsize: Size in meters of the map cells (defaults to 250)
+    :param start: datetime the ride started (optional)
+    :returns: A Fingerprint object
+    """
+
+    sub = {'distance': stream['distance'], 'latlng': stream['latlng']}
+    out = resample.resample(sub, axis='distance', step=step)
+    good = out['mask'] & numpy.isfinite(out['lat']) & \
+        numpy.isfinite(out['lng'])
+    lat = out['lat'][good]
+    lng = out['lng'][good]
+    points = _ecef(lat, lng)
+    cells = _cells(lat, lng, cellsize)
+    length = float(out['distance'][good][-1]) if good.any() else 0.0
+    return Fingerprint(key, points, cells, length, start)
+
+def fingerprint_ride(ride, **args):
+    """Build the route fingerprint of a StravaRide
+
+    Takes the same optional arguments as fingerprint().
+
+    :param ride: A StravaRide object
+    :returns: A Fingerprint keyed by the ride id
+    """
+
+    start = datetime.datetime.strptime(ride.startDate, ride._tstampformat)
+    return fingerprint(ride.id, ride.stream, start=start, **args)
+
+# How many nearby points of the other path to check the segments of
+_NEIGHBORS = 4
+
+def _segment_distance(points, a, b):
+    """Distances from points to the line segments from a to b"""
+
+    ab = b - a
+    length = numpy.maximum((ab * ab).sum(axis=1), 1e-12)
+    along = numpy.clip(((points - a) * ab).sum(axis=1) / length, 0.0, 1.0)
+    closest = a + along[:, None] * ab
+    return numpy.sqrt(((points - closest) ** 2).sum(axis=1))
+
+def _path_distance(points, other, tolerance):
+    """Distances from points to the path of the other fingerprint, inf
+    where it is further than tolerance"""
+
+    count = len(other.points)
+    if count == 1:
+        dist, _ = other.tree.query(points, distance_upper_bound=tolerance)
+        return dist
+    # A point within tolerance of a segment is within tolerance and half
+    # the segment's length of one of its ends; allow a whole typical step
+    spacing = numpy.sqrt((numpy.diff(other.points, axis=0) ** 2).sum(axis=1))
+    step = numpy.median(spacing)
+    bound = tolerance + step
+    # Segments that jump a gap in the recording aren't the road, only
+    # their ends are
+    jumps = spacing > 2 * step
+    neighbors = min(_NEIGHBORS, count)
+    _, index = other.tree.query(points, k=neighbors,
+                                distance_upper_bound=bound)
+    index = index.reshape(len(points), neighbors)
+    best = numpy.empty(len(points))
+    best.fill(numpy.inf)
+    for column in range(neighbors):
+        found = index[:, column] < count
+        near = index[found, column]
+        # The segments on either side of the nearby point
+        for start, end in ((numpy.maximum(near - 1, 0), near),
+                           (near, numpy.minimum(near + 1, count - 1))):
+            jump = (end > start) & jumps[numpy.minimum(start, count - 2)]
+            start = numpy.where(jump, near, start)
+            end = numpy.where(jump, near, end)
+            dist = _segment_distance(points[found], other.points[start],
+                                     other.points[end])
+            best[found] = numpy.minimum(best[found], dist)
+    best[best > tolerance] = numpy.inf
+    return best
+
+def match(a, b, tolerance=50.0, min_fraction=0.9):
+    """Check if two fingerprints follow the same route
+
+    Every point of each path is measured against the other path, and the
+    routes match when enough of both land within tolerance.
+
+    :param a: A Fingerprint object
+    :param b: Another Fingerprint object
+    :param tolerance: Distance in meters points may be apart (defaults to 50)
+    :param min_fraction: Fraction of points of each path that have to be
+                         within tolerance (defaults to 0.9)
+    :returns: True if the routes match
+    """
+
+    if not len(a.points) or not len(b.points):
+        return False
+    for one, other in ((a, b), (b, a)):
+        dist = _path_distance(one.points, other, tolerance)
+        if numpy.isfinite(dist).mean() < min_fraction:
+            return False
+    return True
+
+class _DisjointSet(object):
+    """Union-find over fingerprint keys"""
+
+    def __init__(self, keys):
+        self.parent = dict((key, key) for key in keys)
+
+    def find(self, key):
+        parent = self.parent
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    def union(self, a, b):
+        self.parent[self.find(b)] = self.find(a)
+
+    def groups(self):
+        groups = {}
+        for key in self.parent:
+            groups.setdefault(self.find(key), []).append(key)
+        return list(groups.values())
+
+class RouteIndex(object):
+    """An index of route fingerprints for finding likely matches
+
+    Fingerprints are MinHashed on their cells and bucketed by bands of the
+    hashes, so routes which share most of their cells end up sharing a
+    bucket.
+
+    :param bands: Number of hash bands (defaults to 8)
+    :param rows: Hashes per band (defaults to 4)
+    :param seed: Seed for the hash functions (defaults to 0)
+    """
+
+    def __init__(self, bands=8, rows=4, seed=0):
+        self.bands = bands
+        self.rows = rows
+        rand = numpy.random.RandomState(seed)
+        count = bands * rows
+        self._a = self._random(rand, count) | numpy.uint64(1)
+        self._b = self._random(rand, count)
+        self._buckets = {}
+        self.fingerprints = {}
+
+    @staticmethod
+    def _random(rand, count):
+        # Random 62 bit numbers from two 31 bit halves
+        hi = rand.randint(0, 1 << 31, size=count).astype(numpy.uint64)
+        lo = rand.randint(0, 1 << 31, size=count).astype(numpy.uint64)
+        return (hi << numpy.uint64(31)) | lo
+
+    def _signature(self, fp):
+        # Multiply-shift hashing, wrapping around in 64 bits is intended
+        cells = fp.cells.view(numpy.uint64)[:, None]
+        hashes = (cells * self._a + self._b) >> numpy.uint64(32)
+        return hashes.min(axis=0)
+
+    def _bands(self, fp):
+        if not len(fp.cells):
+            return []
+        sig = self._signature(fp)
+        return [(band, tuple(sig[band * self.rows:(band + 1) * self.rows]))
+                for band in range(self.bands)]
+
+    def add(self, fp):
+        """Add a fingerprint to the index
+
+        :param fp: A Fingerprint object
+        :returns: Nothing
+        """
+
+        self.fingerprints[fp.key] = fp
+        for band in self._bands(fp):
+            self._buckets.setdefault(band, []).append(fp.key)
+
+    def candidates(self, fp, max_length_ratio=1.2):
+        """Find indexed fingerprints that may follow the same route as fp
+
+        :param fp: A Fingerprint object
+        :param max_length_ratio: Largest ratio between route lengths to
+                                 consider (defaults to 1.2)
+        :returns: A set of keys of the candidate fingerprints
+        """
+
+        found = set()
+        for band in self._bands(fp):
+            found.update(self._buckets.get(band, ()))
+        found.discard(fp.key)
+        keep = set()
+        for key in found:
+            length = self.fingerprints[key].length
+            shorter, longer = sorted((length, fp.length))
+            if shorter and longer / shorter <= max_length_ratio:
+                keep.add(key)
+        return keep
+
+    def _pairs(self, max_length_ratio):
+        # Each candidate pair once
+        seen = set()
+        for key, fp in self.fingerprints.items():
+            seen.add(key)
+            for other in self.candidates(fp, max_length_ratio):
+                if other not in seen:
+                    yield fp, self.fingerprints[other]
+
+    def clusters(self, tolerance=50.0, min_fraction=0.9,
+                 max_length_ratio=1.2):
+        """Group the indexed fingerprints by route
+
+        Takes the same tolerance and min_fraction as match().
+
+        :returns: A list of lists of keys, one list per route, largest first
+        """
+
+        routes = _DisjointSet(self.fingerprints)
+        checked = 0
+        for a, b in self._pairs(max_length_ratio):
+            # Already known to be the same route, no need to look closer
+            if routes.find(a.key) == routes.find(b.key):
+                continue
+            checked += 1
+            if match(a, b, tolerance, min_fraction):
+                routes.union(a.key, b.key)
+        log.debug('Confirmed %d candidate pairs for %d rides' %
+                  (checked, len(self.fingerprints)))
+        return sorted(routes.groups(), key=len, reverse=True)
+
+    def duplicates(self, tolerance=10.0, min_fraction=0.98,
+                   max_length_ratio=1.02, max_start_delta=300):
+        """Find fingerprints that look like the same ride uploaded twice
+
+        Pairs have to start within max_start_delta seconds of each other
+        (when start times are known) and follow the same path closely.
+
+        :returns: A list of lists of keys of duplicated rides
+        """
+
+        dupes = _DisjointSet(self.fingerprints)
+        for a, b in self._pairs(max_length_ratio):
+            if a.start and b.start:
+                delta = abs(a.start - b.start)
+                if delta.days * 86400 + delta.seconds > max_start_delta:
+                    continue
+            if dupes.find(a.key) == dupes.find(b.key):
+                continue
+            if match(a, b, tolerance, min_fraction):
+                dupes.union(a.key, b.key)
+        return [group for group in dupes.groups() if len(group) > 1]
+
+def group_rides(rides, **args):
+    """Group StravaRide objects by route
+
+    Takes the same optional arguments as RouteIndex.clusters().
+
+    :param rides: An iterable of StravaRide objects
+    :returns: A list of lists of ride ids, one list per route
+    """
+
+    index = RouteIndex()
+    for ride in rides:
+        index.add(fingerprint_ride(ride))
+    return index.clusters(**args)
+
+def find_duplicates(rides, **args):
+    """Find StravaRide objects that look like duplicate uploads
+
+    Takes the same optional arguments as RouteIndex.duplicates().
+
+    :param rides: An iterable of StravaRide objects
+    :returns: A list of lists of ride ids of duplicated rides
+    """
+
+    index = RouteIndex()
+    for ride in rides:
+        index.add(fingerprint_ride(ride))
+    return index.duplicates(**args)
@@ -0,0 +1,338 @@
+# Copyright (c) 2013 Jesse Keating <jkeating@j2solutions.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# pyendeavor.shared -- hand ride streams to worker processes without pickling
+#
+# A SharedStream packs the columns of a stream into one memory mapped file
+# (in /dev/shm when there is one, so it never touches a disk).  Workers are
+# given just its small descriptor and attach() to get the columns back as
+# ctypes arrays pointing straight into the mapping.  Columns with gaps
+# (None values) carry a mask of which values are there, and hand back None
+# for the gaps just like the stream dict did.  Columns stay readable after
+# the stream they came from is closed; the mapping goes away with the last
+# of them.  For example:
+#
+#   def work(descriptor):
+#       with shared.attach(descriptor) as stream:
+#           return max(stream['heartrate'])
+#
+#   with shared.SharedStream(myride.stream) as published:
+#       pool.map(work, [published.descriptor])
+
+import atexit
+import ctypes
+import mmap
+import os
+import tempfile
+
+from log import log
+
+# Where to put the backing files
+if os.path.isdir('/dev/shm'):
+    SHMDIR = '/dev/shm'
+else:
+    SHMDIR = tempfile.gettempdir()
+
+# Column kinds and the ctypes type each one is stored as
+_KINDS = {'int': ctypes.c_int64,
+          'float': ctypes.c_double,
+          'bool': ctypes.c_bool,
+          'pair': ctypes.c_double}
+# Start every column on a boundary any of the above can live on
+_ALIGN = 8
+
+# Backing files published by this process that haven't been cleaned up yet
+_published = set()
+
+@atexit.register
+def _cleanup():
+    for path in list(_published):
+        _unlink(path)
+
+def _unlink(path):
+    _published.discard(path)
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+def _kind(values):
+    """Figure out how to store a column of stream data"""
+
+    kinds = set()
+    for value in values:
+        if value is None:
+            # Gaps go in the mask, they don't decide the kind
+            continue
+        elif isinstance(value, bool):
+            kinds.add('bool')
+        elif isinstance(value, (list, tuple)):
+            kinds.add('pair')
+        elif isinstance(value, (int, long)):
+            kinds.add('int')
+        else:
+            kinds.add('float')
+    if 'pair' in kinds:
+        return 'pair'
+    if len(kinds) == 1:
+        return kinds.pop()
+    return 'float'
+
+def _fill(values, kind):
+    """Flatten a column into something ctypes can take, zero for gaps"""
+
+    if kind == 'pair':
+        flat = []
+        for value in values:
+            flat.extend(value if value else (0.0, 0.0))
+        return flat
+    return [_KINDS[kind]().value if value is None else value
+            for value in values]
+
+class StreamDescriptor(object):
+    """Everything a worker needs to attach to a SharedStream
+
+    :param path: Path of the backing file
+    :param size: Size of the backing file in bytes
+    :param columns: List of (name, kind, offset, count, mask) tuples, mask
+                    being the offset of the column's presence flags or None
+                    if it has no gaps
+    """
+
+    __slots__ = ('path', 'size', 'columns')
+
+    def __init__(self, path, size, columns):
+        self.path = path
+        self.size = size
+        self.columns = columns
+
+    def __getstate__(self):
+        return (self.path, self.size, self.columns)
+
+    def __setstate__(self, state):
+        self.path, self.size, self.columns = state
+
+class SharedStream(object):
+    """Publish the columns of a stream dict in shared memory
+
+    The backing file lives until close() is called (or the with block
+    ends, or this process exits), so keep this around until every worker
+    is done attaching.
+
+    :param stream: A stream dict, as from StravaRide.stream
+    """
+
+    def __init__(self, stream):
+        columns = []
+        flat = {}
+        size = 0
+        masks = {}
+        for name, values in stream.items():
+            kind = _kind(values)
+            count = len(values) * (2 if kind == 'pair' else 1)
+            offset = size
+            flat[name] = _fill(values, kind)
+            size += ctypes.sizeof(_KINDS[kind]) * count
+            size += -size % _ALIGN
+            mask = None
+            if any(value is None for value in values):
+                mask = size
+                masks[name] = [value is not None for value in values]
+                size += ctypes.sizeof(ctypes.c_bool) * len(values)
+                size += -size % _ALIGN
+            columns.append((name, kind, offset, len(values), mask))
+
+        fd, path = tempfile.mkstemp(prefix='pyendeavor-', dir=SHMDIR)
+        _published.add(path)
+        try:
+            # mmap can't map an empty file
+            os.ftruncate(fd, max(size, 1))
+            mapping = mmap.mmap(fd, max(size, 1))
+            for name, kind, offset, length, mask in columns:
+                count = length * (2 if kind == 'pair' else 1)
+                column = (_KINDS[kind] * count).from_buffer(mapping, offset)
+                column[:] = flat[name]
+                # Let go of the buffer or the mapping can't be closed
+                del column
+                if mask is not None:
+                    column = (ctypes.c_bool * length).from_buffer(mapping,
+                                                                  mask)
+                    column[:] = masks[name]
+                    del column
+            mapping.close()
+        except:
+            _unlink(path)
+            raise
+        finally:
+            os.close(fd)
+        log.debug('Published %d stream columns, %d bytes, at %s' %
+                  (len(columns), size, path))
+        self.descriptor = StreamDescriptor(path, size, columns)
+
+    def close(self):
+        """Remove the shared memory.  Workers that already attached keep
+        their view until they close it.
+
+        :returns: Nothing
+        """
+
+        _unlink(self.descriptor.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class _Pairs(object):
+    """A view of a latlng column that hands back [lat, lng] pairs"""
+
+    def __init__(self, flat):
+        self._flat = flat
+
+    def __len__(self):
+        return len(self._flat) // 2
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('pair index out of range')
+        return self._flat[2 * index:2 * index + 2]
+
+    def __iter__(self):
+        flat = self._flat
+        for index in range(0, len(flat), 2):
+            yield flat[index:index + 2]
+
+class _Gaps(object):
+    """A view of a column with gaps that hands back None for them"""
+
+    def __init__(self, column, mask):
+        self._column = column
+        self._mask = mask
+
+    def __len__(self):
+        return len(self._mask)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('column index out of range')
+        if not self._mask[index]:
+            return None
+        return self._column[index]
+
+    def __iter__(self):
+        column = self._column
+        for index, present in enumerate(self._mask):
+            yield column[index] if present else None
+
+class AttachedStream(object):
+    """A stream attached from shared memory, with the same keys as the
+    stream dict it was published from.  Numeric columns are ctypes arrays
+    and latlng hands back [lat, lng] lists, all reading straight out of
+    the shared memory.  Columns with gaps hand back None for them, as
+    the stream dict did.
+
+    :param descriptor: A StreamDescriptor from a SharedStream
+    """
+
+    def __init__(self, descriptor):
+        self.descriptor = descriptor
+        fileobj = open(descriptor.path, 'rb')
+        try:
+            # A private mapping: the pages are shared with every other
+            # process until someone writes to them, which we don't.
+            self._mapping = mmap.mmap(fileobj.fileno(),
+                                      max(descriptor.size, 1),
+                                      access=mmap.ACCESS_COPY)
+        finally:
+            fileobj.close()
+        self._columns = {}
+        for name, kind, offset, length, mask in descriptor.columns:
+            count = length * (2 if kind == 'pair' else 1)
+            column = (_KINDS[kind] * count).from_buffer(self._mapping, offset)
+            if kind == 'pair':
+                column = _Pairs(column)
+            if mask is not None:
+                column = _Gaps(column, (ctypes.c_bool * length).from_buffer(
+                    self._mapping, mask))
+            self._columns[name] = column
+
+    @property
+    def _live(self):
+        if self._columns is None:
+            raise ValueError('attached stream is closed')
+        return self._columns
+
+    def __getitem__(self, name):
+        return self._live[name]
+
+    def __contains__(self, name):
+        return name in self._live
+
+    def __len__(self):
+        return len(self._live)
+
+    def __iter__(self):
+        return iter(self._live)
+
+    def keys(self):
+        return list(self._live)
+
+    def values(self):
+        return list(self._live.values())
+
+    def items(self):
+        return list(self._live.items())
+
+    def get(self, name, default=None):
+        return self._live.get(name, default)
+
+    def close(self):
+        """Let go of the shared memory.  The stream can't be read from
+        afterwards, but columns already taken from it keep working; the
+        memory is unmapped once the last of them is gone.
+
+        :returns: Nothing
+        """
+
+        # Every column holds a reference to the mapping, and closing it
+        # under them would leave them reading unmapped memory, so just
+        # drop ours and let the last one to go unmap it.
+        self._columns = None
+        self._mapping = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def attach(descriptor):
+    """Attach to a stream published with SharedStream
+
+    :param descriptor: The SharedStream's descriptor
+    :returns: An AttachedStream object
+    """
+
+    return AttachedStream(descriptor)
@@ -23,6 +23,8 @@
 import xml.etree.ElementTree as ET
 import os
 
+import profiling
+
 # Some static bits that go with garmin TCX files
 GARMINEXT = 'http://www.garmin.com/xmlschemas/ActivityExtension/v2'
 _attribs = {
@@ -52,22 +54,80 @@ def _indent(elem, level=0):
         if level and (not elem.tail or not elem.tail.strip()):
             elem.tail = i
 
-# Create a decorator function to make sure the xml is indented before display
-def _do_indent(func):
-    def wrapper(self, *args, **kwargs):
-        _indent(self.root)
-        return func(self, *args, **kwargs)
-    return(wrapper)
+# Trackpoints live at this depth: TrainingCenterDatabase, Activities,
+# Activity, Lap, Track, Trackpoint
+_TRACK_LEVEL = 4
+_POINT_TAIL = "\n" + (_TRACK_LEVEL + 1)*"  "
+_TRACK_TAIL = "\n" + _TRACK_LEVEL*"  "
+# Stand-in for the trackpoints while serializing the rest of the document
+_MARKER = '@@pyendeavor-trackpoints@@'
+
+def _trackpoint(track, time=0, latitude=0, longitude=0, altitude=0,
+                distance=0, speed=0, heartrate=0, cadence=0):
+    # Create the trackpoint element
+    tp = ET.SubElement(track, 'Trackpoint')
+    # Fill in data
+    timeEP = ET.SubElement(tp, 'Time')
+    timeEP.text = str(time)
+    pos = ET.SubElement(tp, 'Position')
+    latEP = ET.SubElement(pos, 'LatitudeDegrees')
+    latEP.text = str(latitude)
+    lonEP = ET.SubElement(pos, 'LongitudeDegrees')
+    lonEP.text = str(longitude)
+    altEP = ET.SubElement(tp, 'AltitudeMeters')
+    altEP.text = str(altitude)
+    distEP = ET.SubElement(tp, 'DistanceMeters')
+    distEP.text = str(distance)
+    extten = ET.SubElement(tp, 'Extensions')
+    texten = ET.SubElement(extten, 'TPX', attrib={'xmlns': GARMINEXT})
+    speedEP = ET.SubElement(texten, 'Speed')
+    speedEP.text = str(speed)
+    if heartrate:
+        hr = ET.SubElement(tp, 'HeartRateBpm')
+        hrEP = ET.SubElement(hr, 'Value')
+        hrEP.text = str(heartrate)
+    if cadence:
+        cadEP = ET.SubElement(tp, 'Cadence')
+        cadEP.text = str(cadence)
+
+# Time a step of _format_chunk, as (stage name, wall, cpu)
+def _split(timings, name, since):
+    now = profiling.clock()
+    timings.append((name, now[0] - since[0], now[1] - since[1]))
+    return now
+
+# Format a chunk of points into indented Trackpoint xml.  This runs in the
+# worker processes so it has to stay a module level function.  Profiling
+# can't see in there, so it hands back how long each step took too.
+def _format_chunk(points):
+    timings = []
+    since = profiling.clock()
+    track = ET.Element('Track')
+    for point in points:
+        _trackpoint(track, **point)
+    since = _split(timings, 'format_points', since)
+    _indent(track, _TRACK_LEVEL)
+    # The last point of a chunk is only the last of the Track if this is
+    # the last chunk; write() sorts that out.
+    track[-1].tail = _POINT_TAIL
+    since = _split(timings, 'indent', since)
+    fragment = ''.join([ET.tostring(tp) for tp in track])
+    _split(timings, 'serialize', since)
+    return fragment, timings
 
 class TCX(object):
     """A class to create TCX objects and manipulate them
 
+    Points added with add_points() are only turned into xml when they are
+    needed: when root, tree, lap or track is looked at, on flush(), or
+    when the TCX is written, which can format them in parallel.
+
     :param starttime: Timestamp in Garmin format for the start of the ride
     """
 
     def __init__(self, starttime):
         # Create a root element to use within our tree
-        self.root = ET.Element(tag='TrainingCenterDatabase', attrib=_attribs)
+        self._root = ET.Element(tag='TrainingCenterDatabase', attrib=_attribs)
         # Everything falls under Activities -- We don't use it after this so
         # doesn't need self.
         activites = ET.Element(tag='Activities')
@@ -76,24 +136,54 @@ class TCX(object):
                                  attrib={'sport': 'Biking'})
         activity_id = ET.SubElement(activity, 'Id')
         activity_id.text = str(starttime)
-        self.lap = ET.SubElement(activity, 'Lap', {'StartTime': str(starttime)})
-        self.track = ET.SubElement(self.lap, 'Track')
+        self._lap = ET.SubElement(activity, 'Lap',
+                                  {'StartTime': str(starttime)})
+        self._track = ET.SubElement(self._lap, 'Track')
 
         # Set up some common things about laps
-        intense = ET.SubElement(self.lap, 'Intensity')
+        intense = ET.SubElement(self._lap, 'Intensity')
         intense.text = 'Active'
-        trig = ET.SubElement(self.lap, 'TriggerMehtod')
+        trig = ET.SubElement(self._lap, 'TriggerMehtod')
         trig.text = 'Manual'
-        cals = ET.SubElement(self.lap, 'Calories')
+        cals = ET.SubElement(self._lap, 'Calories')
         cals.text = '0' # Should we set this?
         
         # Put our activity block into the root
-        self.root.append(activites)
+        self._root.append(activites)
         # Bundle these things up into a tree
-        self.tree = ET.ElementTree(self.root)
+        self._tree = ET.ElementTree(self._root)
         # Define some psuedo properties that lets us set xml data easily
         self._distance = None
         self._duration = None
+        # Points from add_points() which haven't been made into xml yet
+        self._pending = []
+        # Id of the ride this is for, if any, to file profiling data under
+        self.ride_id = None
+
+    # The xml, with any pending points in it
+    @property
+    def root(self):
+        """The TrainingCenterDatabase root element"""
+        self.flush()
+        return self._root
+
+    @property
+    def tree(self):
+        """An ElementTree of the whole document"""
+        self.flush()
+        return self._tree
+
+    @property
+    def lap(self):
+        """The Lap element"""
+        self.flush()
+        return self._lap
+
+    @property
+    def track(self):
+        """The Track element holding the trackpoints"""
+        self.flush()
+        return self._track
 
     # Define some properties to set things
     @property
@@ -103,7 +193,7 @@ class TCX(object):
 
     @distance.setter
     def distance(self, value):
-        delem = ET.SubElement(self.lap, 'DistanceMeters')
+        delem = ET.SubElement(self._lap, 'DistanceMeters')
         delem.text = str(value)
         self._distance = value
 
@@ -114,7 +204,7 @@ class TCX(object):
 
     @duration.setter
     def duration(self, value):
-        delem = ET.SubElement(self.lap, 'TotalTimeSeconds')
+        delem = ET.SubElement(self._lap, 'TotalTimeSeconds')
         delem.text = str(value)
         self._duration = value
 
@@ -133,51 +223,113 @@ class TCX(object):
         :returns: Nothing
         """
 
-        # Create the trackpoint element
-        tp = ET.SubElement(self.track, 'Trackpoint')
-        # Fill in data
-        timeEP = ET.SubElement(tp, 'Time')
-        timeEP.text = str(time)
-        pos = ET.SubElement(tp, 'Position')
-        latEP = ET.SubElement(pos, 'LatitudeDegrees')
-        latEP.text = str(latitude)
-        lonEP = ET.SubElement(pos, 'LongitudeDegrees')
-        lonEP.text = str(longitude)
-        altEP = ET.SubElement(tp, 'AltitudeMeters')
-        altEP.text = str(altitude)
-        distEP = ET.SubElement(tp, 'DistanceMeters')
-        distEP.text = str(distance)
-        extten = ET.SubElement(tp, 'Extensions')
-        texten = ET.SubElement(extten, 'TPX', attrib={'xmlns': GARMINEXT})
-        speedEP = ET.SubElement(texten, 'Speed')
-        speedEP.text = str(speed)
-        if heartrate:
-            hr = ET.SubElement(tp, 'HeartRateBpm')
-            hrEP = ET.SubElement(hr, 'Value')
-            hrEP.text = str(heartrate)
-        if cadence:
-            cadEP = ET.SubElement(tp, 'Cadence')
-            cadEP.text = str(cadence)
-
-    @_do_indent
+        # Keep the points in the order they were added
+        self.flush()
+        _trackpoint(self._track, time, latitude, longitude, altitude,
+                    distance, speed, heartrate, cadence)
+
+    def add_points(self, points):
+        """Add many trackpoints to the ride
+
+        The points are kept as they are and only turned into xml by
+        flush(), or when the TCX is written, which lets write() format them
+        in parallel.
+
+        :param points: iterable of dicts of add_point() arguments
+        :returns: Nothing
+        """
+
+        self._pending.extend(points)
+
+    def flush(self):
+        """Turn points added with add_points() into elements in the tree
+
+        :returns: Nothing
+        """
+
+        if not self._pending:
+            return
+        with profiling.stage('format_points', self.ride_id):
+            for point in self._pending:
+                _trackpoint(self._track, **point)
+        self._pending = []
+
+    def _indent(self):
+        with profiling.stage('indent', self.ride_id):
+            _indent(self._root)
+
     def dump(self):
         """Dump the TCX content to stdout"""
 
-        ET.dump(self.root)
+        self.flush()
+        self._indent()
+        ET.dump(self._root)
 
-    @_do_indent
-    def write(self, path, force=False):
+    def write(self, path, force=False, processes=None, chunksize=5000):
         """Write the tcx content to the file at path
 
+        Points added with add_points() can be formatted in chunks across
+        worker processes, which helps on very long rides.  Otherwise they
+        go into the tree and it is written out as a whole.
+
         :param path: absolute path name to the file
         :param force: force overwrite of existing file (defaults to False)
+        :param processes: number of worker processes to format pending
+                          points with (defaults to None, no workers)
+        :param chunksize: number of points per chunk (defaults to 5000)
         :returns: nothing
         """
 
         if os.path.exists(path) and not force:
             raise IOError('file %s exists' % path)
+        # Workers only help with more than a chunk of points, and if points
+        # were added one at a time they're already in the tree, so there is
+        # nothing to split up; just add the rest in behind them.
+        parallel = processes and len(self._pending) > chunksize and \
+            not len(self._track)
+        if not parallel:
+            self.flush()
+        self._indent()
         # Open the file and add our header
         fileobj = open(path, 'w')
         fileobj.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-        # now dump in our tcx xml
-        self.tree.write(fileobj)
+        if not parallel:
+            # now dump in our tcx xml
+            with profiling.stage('serialize', self.ride_id):
+                self._tree.write(fileobj)
+            fileobj.close()
+            return
+
+        # Only worth the import when there are workers to start
+        import multiprocessing
+        chunks = [self._pending[i:i + chunksize]
+                  for i in range(0, len(self._pending), chunksize)]
+        with profiling.stage('format_chunks', self.ride_id):
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_format_chunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        fragments = []
+        for fragment, timings in results:
+            fragments.append(fragment)
+            for name, wall, cpu in timings:
+                profiling.record(name, wall, cpu, self.ride_id)
+        # The last point closes the Track, so indent it to match
+        fragments[-1] = fragments[-1][:-len(_POINT_TAIL)] + _TRACK_TAIL
+
+        # Serialize everything else with a marker inside the Track and
+        # stitch the trackpoints in where it lands.
+        with profiling.stage('serialize', self.ride_id):
+            self._track.text = _MARKER
+            try:
+                head, tail = ET.tostring(self._root).split(_MARKER)
+            finally:
+                self._track.text = None
+            fileobj.write(head)
+            fileobj.write(_POINT_TAIL)
+            for fragment in fragments:
+                fileobj.write(fragment)
+            fileobj.write(tail)
+        fileobj.close()